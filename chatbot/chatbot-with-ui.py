@@ -1,5 +1,127 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-from chatbot import chatbot_query  # Import chatbot query function
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Number of most recent messages shown, older ones are revealed a page at a time
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "20"))
+# Seconds between checks for a finished answer while the query runs in the background
+ANSWER_POLL_INTERVAL = float(os.getenv("ANSWER_POLL_INTERVAL", "0.5"))
+# Number of queries that can be answered concurrently across all sessions
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "4"))
+
+
+@st.cache_resource
+def load_chatbot():
+    """
+    Imports the chatbot module once per server process, so the spaCy model,
+    OpenAI client and CrateDB session are shared by every rerun and session.
+    """
+    import chatbot
+    return chatbot
+
+
+@st.cache_resource
+def get_query_executor():
+    """
+    Thread pool that runs retrieval and answer generation off the script thread.
+    """
+    return ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="chatbot-query")
+
+
+@st.cache_data
+def list_documents():
+    """
+    Lists the PDF documents served from the static folder, for the sidebar filter.
+    """
+    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    return sorted(f for f in os.listdir(static_dir) if f.endswith(".pdf"))
+
+
+def sidebar_filters():
+    """
+    Renders the metadata filter controls in the sidebar.
+
+    Returns:
+    - dict: Filters to pass to `chatbot_query`.
+    """
+    st.sidebar.header("Filters")
+    documents = st.sidebar.multiselect("Documents", list_documents())
+    content_types = st.sidebar.multiselect("Content type", ["text", "image"])
+    page_from = st.sidebar.number_input("From page", min_value=1, value=None, step=1)
+    page_to = st.sidebar.number_input("To page", min_value=1, value=None, step=1)
+    return {
+        "document_name": documents,
+        "page_from": page_from,
+        "page_to": page_to,
+        "content_type": content_types,
+    }
+
+
+def render_user_message(content):
+    return f"""
+        <div class="chat-message user-message">
+            <div><strong>You:</strong> {content}</div>
+        </div>
+        """
+
+
+def render_assistant_message(content):
+    # Render the assistant response with additional spacing
+    content = content.replace("\n", "<br>")
+    return f"""
+        <div class="chat-message bot-message">
+            <div><strong>Assistant:</strong><br>{content}</div>
+        </div>
+        """
+
+
+def format_response(response):
+    """
+    Cleans the chatbot response and appends a list of linked sources.
+    """
+    sources = []
+    for source in response.get("results", []):
+        sources.append(f"""<li><a href="app/static/{source["doc"]}#page={source["page"]}" target="_blank">{source["doc"]}</a> (page {source["page"]}, {source["type"]}, {source["collection"]}, score: {source["score"]})</li>""")
+        # Chunks deduplicated at ingest, which also appear at these locations
+        for duplicate in source.get("duplicates", []):
+            sources.append(f"""<li><a href="app/static/{duplicate["doc"]}#page={duplicate["page"]}" target="_blank">{duplicate["doc"]}</a> (page {duplicate["page"]}, same text)</li>""")
+
+    answer = response["response"].replace("\033[92m", "").replace("\033[0m", "").strip()
+    return f"{answer}<br><br><strong>Sources:</strong><br><ul>{''.join(sources)}</ul>"
+
+
+def add_message(role, content):
+    """
+    Appends a message to the chat history, rendering its HTML once so reruns
+    only replay the cached markup.
+    """
+    render = render_user_message if role == "user" else render_assistant_message
+    st.session_state.messages.append({"role": role, "content": content, "html": render(content)})
+
+
+def answer_when_ready():
+    """
+    Polls the background query and adds the assistant message once it finishes.
+    """
+    future = st.session_state.pending_query
+    if future is None:
+        return
+    if not future.done():
+        st.markdown(render_assistant_message("<em>Thinking...</em>"), unsafe_allow_html=True)
+        return
+
+    st.session_state.pending_query = None
+    try:
+        add_message("assistant", format_response(future.result()))
+    except Exception as e:
+        # Handle errors gracefully
+        add_message("assistant", f"An error occurred: {e}")
+    st.rerun()
+
 
 # Configure the Streamlit page
 st.set_page_config(
@@ -44,66 +166,51 @@ st.markdown("""
 # Initialize chat history
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "history_pages" not in st.session_state:
+    st.session_state.history_pages = 1
+if "pending_query" not in st.session_state:
+    st.session_state.pending_query = None
+if "conversation" not in st.session_state:
+    st.session_state.conversation = load_chatbot().new_conversation()
 
 # Header
 st.title("📚 Document QA Chatbot")
 st.markdown("Ask questions about your documents and get AI-powered answers with source references.")
 
-# Chat input
-user_query = st.chat_input("Ask a question...")
+# Metadata filters applied to each question
+filters = sidebar_filters()
+
+# Chat input, disabled while an answer is still being generated
+user_query = st.chat_input("Ask a question...", disabled=st.session_state.pending_query is not None)
 
-# Process user input
+# Process user input in the background so the page stays responsive
 if user_query:
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": user_query})
-    
-    # Show a loading spinner while processing the response
-    with st.spinner("Thinking..."):
-        try:
-            # Get chatbot response
-            response = chatbot_query(user_query)
-
-            # Clean and parse response, add header text for sources.
-            sources = []
-            for source in response["results"]:
-                sources.append(f"""<li><a href="app/static/{source["doc"]}#page={source["page"]}" target="_blank">{source["doc"]}</a> (page {source["page"]}, {source["type"]}, score: {source["score"]})</li>""")
-
-            formatted_response = f"{response['response'].replace("\033[92m", "").replace("\033[0m", "").strip()}<br><br><strong>Sources:</strong><br><ul>{''.join(sources)}</ul>"
-            
-            # Append assistant response as a single message
-            st.session_state.messages.append({"role": "assistant", "content": formatted_response})
-
-        except Exception as e:
-            # Handle errors gracefully
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": f"An error occurred: {e}"
-            })
-
-
-# Display chat history
-for message in st.session_state.messages:
-    if message["role"] == "user":
-        with st.container():
-            st.markdown(f"""
-                <div class="chat-message user-message">
-                    <div><strong>You:</strong> {message["content"]}</div>
-                </div>
-                """, 
-                unsafe_allow_html=True
-            )
-    elif message["role"] == "assistant":
-        with st.container():
-            # Render the assistant response with additional spacing
-            st.markdown(f"""
-                <div class="chat-message bot-message">
-                    <div><strong>Assistant:</strong><br>{message["content"].replace("\n", "<br>")}</div>
-                </div>
-                """, 
-                unsafe_allow_html=True
-            )
+    add_message("user", user_query)
+    st.session_state.pending_query = get_query_executor().submit(
+        load_chatbot().chatbot_query, user_query, filters, st.session_state.conversation
+    )
+    st.rerun()
+
+# Display the most recent page(s) of chat history, collapsing older messages
+visible_count = CHAT_HISTORY_WINDOW * st.session_state.history_pages
+hidden_count = len(st.session_state.messages) - visible_count
+if hidden_count > 0 and st.button(f"Show earlier messages ({hidden_count} hidden)"):
+    st.session_state.history_pages += 1
+    st.rerun()
+
+for message in st.session_state.messages[-visible_count:]:
+    st.markdown(message["html"], unsafe_allow_html=True)
+
+# Only this fragment reruns while waiting for an answer
+st.fragment(
+    answer_when_ready,
+    run_every=ANSWER_POLL_INTERVAL if st.session_state.pending_query is not None else None,
+)()
 
 # Add a clear chat button in the sidebar
 if st.sidebar.button("Clear Chat"):
     st.session_state.messages = []
-    st.rerun()
\ No newline at end of file
+    st.session_state.history_pages = 1
+    st.session_state.pending_query = None
+    st.session_state.conversation = load_chatbot().new_conversation()
+    st.rerun()
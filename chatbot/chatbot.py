@@ -1,6 +1,12 @@
+import argparse
+import json
+import logging
 import os
 import re
 import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import spacy
 from dotenv import load_dotenv
 from openai import OpenAI
@@ -20,6 +26,19 @@ TEXT_EMBEDDING_MODEL = os.getenv("TEXT_EMBEDDING_MODEL")
 SPACY_MODEL = os.getenv("SPACY_MODEL")
 CHAT_RESPONSE_TEMPERATURE = float(os.getenv("CHAT_RESPONSE_TEMPERATURE"))
 CHAT_RESPONSE_MAX_TOKENS = int(os.getenv("CHAT_RESPONSE_MAX_TOKENS"))
+SEARCH_COLLECTIONS = os.getenv("SEARCH_COLLECTIONS") or COLLECTION_NAME
+SEARCH_COLLECTION_TIMEOUT = float(os.getenv("SEARCH_COLLECTION_TIMEOUT", "5"))
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "8"))
+KNN_FILTER_CANDIDATES_FACTOR = int(os.getenv("KNN_FILTER_CANDIDATES_FACTOR", "10"))
+PLANNER_MIN_SCORE = float(os.getenv("PLANNER_MIN_SCORE", "0.4"))
+PLANNER_RELATIVE_CUTOFF = float(os.getenv("PLANNER_RELATIVE_CUTOFF", "0.3"))
+PLANNER_FLAT_SPREAD = float(os.getenv("PLANNER_FLAT_SPREAD", "0.05"))
+PLANNER_MIN_RESULTS = int(os.getenv("PLANNER_MIN_RESULTS", "1"))
+PLANNER_MAX_RESULTS = int(os.getenv("PLANNER_MAX_RESULTS", str(RESULTS_LIMIT * 2)))
+PLANNER_LOG_FILE = os.getenv("PLANNER_LOG_FILE")
+CONVERSATION_RECENT_TURNS = int(os.getenv("CONVERSATION_RECENT_TURNS", "3"))
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "800"))
+CONVERSATION_SUMMARY_MAX_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_MAX_TOKENS", "200"))
 
 # Load spaCy model
 nlp = spacy.load(SPACY_MODEL)
@@ -27,22 +46,62 @@ nlp = spacy.load(SPACY_MODEL)
 # Instantiate OpenAI client
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+# One HTTP session per thread, so CrateDB connections are pooled and reused
+# across queries without sharing a session between threads
+cratedb_sessions = threading.local()
+
+# Whether each collection has the structured duplicate_locations column,
+# looked up once per table
+duplicate_columns = {}
+duplicate_columns_lock = threading.Lock()
+
+# Thread pool for running the KNN and BM25 legs of each collection in parallel
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+# Thread pool for summarizing conversations after an answer has been returned
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
 # Debug flag for debugging intermediate steps
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 
+# Query planner decisions are written as JSON lines, for tuning the PLANNER_* settings
+planner_logger = logging.getLogger("query_planner")
+if PLANNER_LOG_FILE:
+    planner_logger.addHandler(logging.FileHandler(PLANNER_LOG_FILE))
+    planner_logger.setLevel(logging.INFO)
+    planner_logger.propagate = False
+
 # ANSI escape codes for formatting
 GREEN = "\033[92m"
 RESET = "\033[0m"
 
+# Words that refer back to an earlier turn, in case the tagger misses them
+FOLLOWUP_REFERENCES = {"it", "its", "they", "them", "their", "this", "that", "these", "those"}
+
+
+def get_cratedb_session():
+    session = getattr(cratedb_sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        cratedb_sessions.session = session
+    return session
+
 
-def execute_cratedb_query(query, args=None):
+def execute_cratedb_query(query, args=None, timeout=None):
     data = {"stmt": query}
     if args:
         data["args"] = args
 
-    response = requests.post(
-        CRATEDB_URL, json=data, auth=HTTPBasicAuth(CRATEDB_USERNAME, CRATEDB_PASSWORD)
-    )
+    try:
+        response = get_cratedb_session().post(
+            CRATEDB_URL,
+            json=data,
+            auth=HTTPBasicAuth(CRATEDB_USERNAME, CRATEDB_PASSWORD),
+            timeout=timeout,
+        )
+    except requests.RequestException as e:
+        print(f"CrateDB query failed: {e}") if DEBUG else None
+        return None
 
     if response.status_code != 200:
         print(f"CrateDB query failed: {response.text}") if DEBUG else None
@@ -59,6 +118,172 @@ def extract_keywords_pos(question):
     return " ".join(keywords)
 
 
+def parse_collections(collections):
+    """
+    Parses a comma separated list of collections, each optionally followed by
+    its own timeout in seconds, e.g. "pdf_data,pdf_data_de:2.5".
+
+    Returns:
+    - list: A list of (collection_name, timeout) tuples.
+    """
+    if isinstance(collections, str):
+        collections = collections.split(",")
+
+    parsed = []
+    for entry in collections:
+        if isinstance(entry, tuple):
+            parsed.append(entry)
+            continue
+        name, _, timeout = entry.strip().partition(":")
+        if name:
+            parsed.append((name, float(timeout) if timeout else SEARCH_COLLECTION_TIMEOUT))
+    return parsed
+
+
+def location_filters(filters):
+    """
+    Extracts the document and page filters.
+
+    Returns:
+    - tuple: (documents, page_from, page_to), with documents as a list or None.
+    """
+    filters = filters or {}
+    documents = filters.get("document_name")
+    if isinstance(documents, str):
+        documents = [documents]
+    page_from = filters.get("page_from")
+    page_to = filters.get("page_to")
+    return (
+        list(documents) if documents else None,
+        int(page_from) if page_from is not None else None,
+        int(page_to) if page_to is not None else None,
+    )
+
+def location_matches(document_name, page_number, filters):
+    documents, page_from, page_to = location_filters(filters)
+    return (
+        (documents is None or document_name in documents)
+        and (page_from is None or page_number >= page_from)
+        and (page_to is None or page_number <= page_to)
+    )
+
+def row_matches_filters(row, filters):
+    """
+    Checks that a result row, or one of its duplicate locations, lies inside
+    the document and page filters.
+    """
+    if location_matches(row[1], row[2], filters):
+        return True
+    return any(
+        location_matches(location["document_name"], location["page_number"], filters)
+        for location in row[6] or []
+    )
+
+def has_duplicate_locations(collection_name):
+    """
+    Checks whether a collection has the `duplicate_locations` column written by
+    the data extractor's duplicate detection.
+
+    Notes:
+    - Tables ingested before duplicate detection lack the column, or hold it
+      in an older layout, and are searched without it.
+    - The answer is cached per table. A failed lookup is not cached, and the
+      table is searched without the column in the meantime.
+    """
+    with duplicate_columns_lock:
+        if collection_name in duplicate_columns:
+            return duplicate_columns[collection_name]
+
+    schema, _, table = collection_name.lower().rpartition(".")
+    response = execute_cratedb_query(
+        """
+        SELECT data_type
+        FROM information_schema.columns
+        WHERE table_schema = ? AND table_name = ? AND column_name = 'duplicate_locations'
+        """,
+        [schema or "doc", table],
+    )
+    if response is None or "rows" not in response:
+        return False
+
+    present = any(row[0] == "object_array" for row in response["rows"])
+    with duplicate_columns_lock:
+        duplicate_columns[collection_name] = present
+    return present
+
+def build_filter_clause(filters, duplicates=True):
+    """
+    Builds SQL conditions for metadata filters, using bound parameters.
+
+    Parameters:
+    - filters (dict): Optional keys:
+      - "document_name" (str or list): Only search these documents.
+      - "page_from" (int): Lowest page number to search.
+      - "page_to" (int): Highest page number to search.
+      - "content_type" (str or list): Only search these content types ("text", "image").
+    - duplicates (bool): Whether the table has a `duplicate_locations` column.
+
+    Returns:
+    - tuple: A string of " AND ..." conditions to append to a WHERE clause, and
+      the list of arguments for its placeholders.
+
+    Notes:
+    - Document and page filters also match rows with a `duplicate_locations`
+      entry (chunks deduplicated at ingest) inside them. SQL can only check the
+      document and each page bound against any entry, not against the same
+      one, so search results are re-checked with `row_matches_filters`.
+    """
+    conditions = []
+    args = []
+    if not filters:
+        return "", args
+
+    content_types = filters.get("content_type")
+    if content_types:
+        conditions.append("content_type = ANY(?)")
+        args.append([content_types] if isinstance(content_types, str) else list(content_types))
+
+    documents, page_from, page_to = location_filters(filters)
+    canonical_conditions = []
+    duplicate_conditions = []
+    location_args = []
+    duplicate_args = []
+    if documents:
+        canonical_conditions.append("document_name = ANY(?)")
+        location_args.append(documents)
+        duplicate_conditions.append(
+            "(" + " OR ".join("? = ANY(duplicate_locations['document_name'])" for _ in documents) + ")"
+        )
+        duplicate_args.extend(documents)
+    if page_from is not None:
+        canonical_conditions.append("page_number >= ?")
+        location_args.append(page_from)
+        duplicate_conditions.append("? <= ANY(duplicate_locations['page_number'])")
+        duplicate_args.append(page_from)
+    if page_to is not None:
+        canonical_conditions.append("page_number <= ?")
+        location_args.append(page_to)
+        duplicate_conditions.append("? >= ANY(duplicate_locations['page_number'])")
+        duplicate_args.append(page_to)
+
+    if canonical_conditions and not duplicates:
+        conditions.extend(canonical_conditions)
+        args.extend(location_args)
+    elif canonical_conditions:
+        conditions.append(
+            f"(({' AND '.join(canonical_conditions)}) OR ({' AND '.join(duplicate_conditions)}))"
+        )
+        args.extend(location_args + duplicate_args)
+
+    return "".join(f" AND {condition}" for condition in conditions), args
+
+def duplicate_column(duplicates):
+    """
+    Returns the select expression for `duplicate_locations`, keeping the row
+    layout the same for tables without the column.
+    """
+    return "duplicate_locations" if duplicates else "NULL AS duplicate_locations"
+
 def get_text_embedding(text):
     """
     Generates a vector embedding for a given text using OpenAI's embedding model.
@@ -70,37 +295,52 @@ def get_text_embedding(text):
         print(f"Error generating embedding: {e}") if DEBUG else None
         return None
 
-def knn_search(query_embedding, collection_name, results_limit=RESULTS_LIMIT):
+def knn_search(
+    query_embedding, collection_name, results_limit=RESULTS_LIMIT, timeout=None, filters=None
+):
     """
     Searches the vector index in CrateDB using a KNN algorithm.
     Parameters:
     - query_embedding: Vector embedding of the query
     - collection_name: Name of the database collection
     - results_limit: Number of results to return
+    - timeout: Seconds to wait for CrateDB before giving up
+    - filters: Metadata filters, see `build_filter_clause`
+
+    Notes:
+    - knn_match finds its nearest neighbours before the filters are applied, so
+      filtered searches ask it for KNN_FILTER_CANDIDATES_FACTOR times as many
+      candidates to leave enough rows after filtering.
     """
     embedding_string = ",".join(map(str, query_embedding))
+    duplicates = has_duplicate_locations(collection_name)
+    filter_clause, filter_args = build_filter_clause(filters, duplicates)
+    candidates = results_limit * KNN_FILTER_CANDIDATES_FACTOR if filter_clause else results_limit
     if DEBUG:
         print(
             f"\n### KNN Search Query Embedding (first 10): {query_embedding[:10]} ###\n"
         )
 
     query = f"""
-    SELECT id, document_name, page_number, content_type, content, _score
+    SELECT id, document_name, page_number, content_type, content, _score, {duplicate_column(duplicates)}
     FROM {collection_name}
-    WHERE knn_match(content_embedding, ARRAY[{embedding_string}], {results_limit})
+    WHERE knn_match(content_embedding, ARRAY[{embedding_string}], {candidates}){filter_clause}
     ORDER BY _score DESC
     LIMIT {results_limit}
     """
-    response = execute_cratedb_query(query)
+    response = execute_cratedb_query(query, filter_args, timeout=timeout)
     if response and "rows" in response:
+        rows = [row for row in response["rows"] if row_matches_filters(row, filters)]
         if DEBUG:
-            print(f"\n### KNN Search Results ({len(response['rows'])} rows): ###")
-            for row in response["rows"]:
-                print(f"Page {row[2]} (Score: {row[-1]}): {row[4][:200]}...")
-        return response["rows"]
+            print(f"\n### KNN Search Results ({len(rows)} rows): ###")
+            for row in rows:
+                print(f"Page {row[2]} (Score: {row[5]}): {row[4][:200]}...")
+        return rows
     return []
 
-def full_text_search(keywords, collection_name, results_limit=RESULTS_LIMIT):
+def full_text_search(
+    keywords, collection_name, results_limit=RESULTS_LIMIT, timeout=None, filters=None
+):
     """
     Searches the full-text index in CrateDB using BM25 (Best Matching 25) algorithm.
 
@@ -108,6 +348,8 @@ def full_text_search(keywords, collection_name, results_limit=RESULTS_LIMIT):
     - keywords (str): The extracted keywords from the user's query.
     - collection_name (str): The name of the database collection to search.
     - results_limit (int): The maximum number of results to return.
+    - timeout (float): Seconds to wait for CrateDB before giving up.
+    - filters (dict): Metadata filters, see `build_filter_clause`.
 
     Returns:
     - list: A list of rows containing the matching records, including their scores and metadata.
@@ -119,18 +361,26 @@ def full_text_search(keywords, collection_name, results_limit=RESULTS_LIMIT):
     if DEBUG:
         print(f'\n### BM25 Search Query: "{keywords}" ###\n')
 
+    duplicates = has_duplicate_locations(collection_name)
+    filter_clause, filter_args = build_filter_clause(filters, duplicates)
     query = f"""
-    SELECT id, document_name, page_number, content_type, content, _score AS bm25_score
+    SELECT id, document_name, page_number, content_type, content, _score AS bm25_score, {duplicate_column(duplicates)}
     FROM {collection_name}
-    WHERE MATCH(content, '{keywords}')
+    WHERE MATCH(content, ?){filter_clause}
     ORDER BY bm25_score DESC
     LIMIT {results_limit}
     """
-    response = execute_cratedb_query(query)
-    return response["rows"] if response and "rows" in response else []
+    response = execute_cratedb_query(query, [keywords] + filter_args, timeout=timeout)
+    if response and "rows" in response:
+        return [row for row in response["rows"] if row_matches_filters(row, filters)]
+    return []
 
 def perform_hybrid_search(
-    question, alpha=0.8, collection_name=COLLECTION_NAME, results_limit=RESULTS_LIMIT
+    question,
+    alpha=0.8,
+    collection_name=COLLECTION_NAME,
+    results_limit=RESULTS_LIMIT,
+    filters=None,
 ):
     """
     Parameters:
@@ -138,54 +388,364 @@ def perform_hybrid_search(
     - alpha (float): Weight for KNN scores in the hybrid scoring formula.
     - collection_name (str): The name of the database collection to search.
     - results_limit (int): The maximum number of results to return.
+    - filters (dict): Metadata filters, see `build_filter_clause`.
 
     Returns:
     - list: A list of rows containing the combined results, sorted by hybrid scores.
 
+    Notes:
+    - Equivalent to `perform_fanout_search` over a single collection.
+    """
+    return perform_fanout_search(question, alpha, [collection_name], results_limit, filters)
+
+def perform_fanout_search(
+    question,
+    alpha=0.8,
+    collections=SEARCH_COLLECTIONS,
+    results_limit=RESULTS_LIMIT,
+    filters=None,
+):
+    """
+    Runs a hybrid search across several collections in parallel and merges the results.
+
+    Parameters:
+    - question (str): The user's input question.
+    - alpha (float): Weight for KNN scores in the hybrid scoring formula.
+    - collections (str or list): Collections to search, see `parse_collections`.
+    - results_limit (int): The maximum number of results to return.
+    - filters (dict): Metadata filters applied inside both SQL queries, see `build_filter_clause`.
+
+    Returns:
+    - list: A list of rows sorted by hybrid score, each with the name of its
+      originating collection appended as the last column.
+
     Process:
-    1. Generates a query embedding and extracts keywords.
-    2. Performs KNN search and BM25 search independently.
-    3. Normalizes scores and combines results with weighted averaging.
-    4. Returns the top results sorted by hybrid scores.
+    1. Plans which searches to run (see `plan_query`).
+    2. Runs them for every collection in parallel (see `search_collections`).
+    3. Normalizes scores across all collections and combines them with weighted averaging.
+    """
+    plan = plan_query(question)
+    query_embedding = embed_question(question, plan)
+    knn_results, bm25_results = search_collections(
+        query_embedding, plan["keywords"] if plan["use_bm25"] else None, collections, results_limit, filters
+    )
+    return merge_hybrid_results(knn_results, bm25_results, alpha, results_limit)
+
+def embed_question(question, plan):
+    """
+    Generates the query embedding if the plan uses the KNN search.
+
+    Returns:
+    - list: The embedding, or None if KNN is skipped or the embedding failed,
+      in which case the plan is updated to skip KNN.
     """
-    query_embedding = get_text_embedding(question)
-    keywords = extract_keywords_pos(question)
+    query_embedding = get_text_embedding(question) if plan["use_knn"] else None
+    if plan["use_knn"] and query_embedding is None:
+        plan.update(use_knn=False, reason=plan["reason"] + ", embedding failed")
+    return query_embedding
+
+def leg_rows(future, deadline):
+    """
+    Waits for a search leg until the deadline and returns its rows, or an empty
+    list if the leg was skipped or did not finish in time.
+    """
+    if future is None:
+        return []
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except TimeoutError:
+        # Not started yet if it is still queued, otherwise its result is ignored
+        future.cancel()
+        return []
+
+def search_collections(query_embedding, keywords, collections, results_limit, filters=None):
+    """
+    Runs the KNN and BM25 searches against every collection.
+
+    Parameters:
+    - query_embedding (list): Embedding for the KNN search, or None to skip it.
+    - keywords (str): Keywords for the BM25 search, or None to skip it.
+    - collections (str or list): Collections to search, see `parse_collections`.
+    - results_limit (int): The maximum number of results per search.
+    - filters (dict): Metadata filters, see `build_filter_clause`.
+
+    Returns:
+    - tuple: The KNN rows and the BM25 rows, each with the originating collection
+      appended as the last column.
+
+    Notes:
+    - Searches are submitted to a thread pool, each with its collection's timeout.
+      A collection that is slow or missing only drops its own results.
+    - Each collection's results are awaited until its timeout has passed since
+      submission, including time spent queued in the pool, so a slow table
+      cannot hold up the answer.
+    """
+    searches = []
+    for collection_name, timeout in parse_collections(collections):
+        deadline = time.monotonic() + timeout
+        knn_future = bm25_future = None
+        if query_embedding is not None:
+            knn_future = search_executor.submit(
+                knn_search, query_embedding, collection_name, results_limit, timeout, filters
+            )
+        if keywords:
+            bm25_future = search_executor.submit(
+                full_text_search, keywords, collection_name, results_limit, timeout, filters
+            )
+        searches.append((collection_name, deadline, knn_future, bm25_future))
+
+    knn_results = []
+    bm25_results = []
+    for collection_name, deadline, knn_future, bm25_future in searches:
+        # Failed or timed out legs come back empty, so only this collection is affected
+        collection_knn = [row + [collection_name] for row in leg_rows(knn_future, deadline)]
+        collection_bm25 = [row + [collection_name] for row in leg_rows(bm25_future, deadline)]
+        if DEBUG and not collection_knn and not collection_bm25:
+            print(f"\n### No results from collection {collection_name} ###\n")
+        knn_results.extend(collection_knn)
+        bm25_results.extend(collection_bm25)
+
+    return knn_results, bm25_results
+
+def extract_identifier(question):
+    """
+    Detects questions that are just an exact identifier lookup, such as an
+    error code, setting name or version number, or a fully quoted phrase.
+
+    Returns:
+    - str: The identifier or phrase to look up.
+    - None: If the question is not an exact lookup.
+    """
+    text = question.strip().rstrip("?").strip()
+    quoted = re.fullmatch(r"[\"'`](.+)[\"'`]", text)
+    if quoted:
+        return quoted.group(1)
+    if re.fullmatch(r"[\w.\-:/#]+", text) and re.search(r"\d|_|[a-z][A-Z]|^[A-Z]{2,}$", text):
+        return text
+    return None
+
+def plan_query(question):
+    """
+    Decides which retrieval legs a question needs.
+
+    Parameters:
+    - question (str): The user's input question.
+
+    Returns:
+    - dict: The plan, with "keywords" for BM25, "use_knn" and "use_bm25" flags,
+      and a "reason" describing the decision.
+
+    Rules:
+    - Exact identifier lookups skip the KNN search and use the identifier as the BM25 query.
+    - Questions without keywords skip the BM25 search.
+    - Everything else runs both searches.
+    """
+    identifier = extract_identifier(question)
+    if identifier:
+        plan = {"keywords": identifier, "use_knn": False, "use_bm25": True, "reason": "exact identifier"}
+    else:
+        keywords = extract_keywords_pos(question)
+        if keywords.strip():
+            plan = {"keywords": keywords, "use_knn": True, "use_bm25": True, "reason": "hybrid"}
+        else:
+            plan = {"keywords": "", "use_knn": True, "use_bm25": False, "reason": "no keywords"}
 
     if DEBUG:
-        print(f"\nExtracted Keywords for BM25: {keywords}\n")
+        print(f"\nExtracted Keywords for BM25: {plan['keywords']}\n")
+    return plan
 
-    knn_results = knn_search(query_embedding, collection_name, results_limit)
-    bm25_results = full_text_search(keywords, collection_name, results_limit)
+def leg_relevance(rows):
+    """
+    Normalizes the scores of one search leg between its best and worst row.
 
-    # Normalize and merge results
-    knn_max = max(row[-1] for row in knn_results) if knn_results else 1
-    bm25_max = max(row[-1] for row in bm25_results) if bm25_results else 1
+    Parameters:
+    - rows (list): Rows from one leg, with the score in column 5 and the collection last.
+
+    Returns:
+    - tuple: A dict of relevance from 0 to 1 keyed by (collection, id), and
+      whether the leg is flat, i.e. its scores spread by less than
+      PLANNER_FLAT_SPREAD of the best score and cannot tell rows apart.
+      Rows of a flat leg all get a relevance of 1.
+    """
+    if not rows:
+        return {}, False
+    scores = [row[5] for row in rows]
+    top, bottom = max(scores), min(scores)
+    if top <= 0 or (top - bottom) / top < PLANNER_FLAT_SPREAD:
+        return {(row[-1], row[0]): 1.0 for row in rows}, True
+    return {(row[-1], row[0]): (row[5] - bottom) / (top - bottom) for row in rows}, False
+
+def select_results(ranked, relevance, leg_rank):
+    """
+    Picks which hybrid results to pass to the LLM.
+
+    Parameters:
+    - ranked (list): Results from `rank_hybrid_results`, best first.
+    - relevance (dict): Best per-leg relevance of each result, from `leg_relevance`.
+    - leg_rank (dict): Best position of each result within its own leg.
+
+    Returns:
+    - list: The rows to use, in hybrid order.
+
+    Notes:
+    - Keeps results whose relevance in either leg is at least
+      PLANNER_RELATIVE_CUTOFF, so the top BM25 hits survive next to KNN hits
+      and weak tails are dropped, within PLANNER_MIN_RESULTS and PLANNER_MAX_RESULTS.
+    - When more than PLANNER_MAX_RESULTS qualify, the legs take turns, so one
+      leg cannot crowd out the other.
+    """
+    def key(result):
+        return (result["data"][-1], result["data"][0])
+
+    kept = [result for result in ranked if relevance.get(key(result), 0) >= PLANNER_RELATIVE_CUTOFF]
+    if len(kept) < PLANNER_MIN_RESULTS:
+        kept = ranked[:PLANNER_MIN_RESULTS]
+    if len(kept) > PLANNER_MAX_RESULTS:
+        order = {id(result): position for position, result in enumerate(kept)}
+        kept = sorted(kept, key=lambda result: (leg_rank[key(result)], order[id(result)]))
+        kept = sorted(kept[:PLANNER_MAX_RESULTS], key=lambda result: order[id(result)])
+    return [result["data"] for result in kept]
+
+def log_plan(plan):
+    planner_logger.info(json.dumps(plan))
+    print(f"\n### Query Plan: {plan} ###\n") if DEBUG else None
+
+def planned_search(question, alpha=0.8, collections=SEARCH_COLLECTIONS, filters=None):
+    """
+    Runs only the retrieval work a question needs, then picks the results
+    worth passing to the LLM from their scores.
+
+    Parameters:
+    - question (str): The user's input question.
+    - alpha (float): Weight for KNN scores in the hybrid scoring formula.
+    - collections (str or list): Collections to search, see `parse_collections`.
+    - filters (dict): Metadata filters, see `build_filter_clause`.
+
+    Returns:
+    - list: Result rows as returned by `perform_fanout_search`.
+    - Empty list: If nothing was found or the best KNN score is below
+      PLANNER_MIN_SCORE, so the caller can answer "not found" without the LLM.
+
+    Process:
+    1. Fetches RESULTS_LIMIT rows from each planned leg.
+    2. Answers "not found" if the best KNN score is too low.
+    3. Fetches again with PLANNER_MAX_RESULTS, only for legs that came back
+       full and flat, since more equally good rows may follow.
+    4. Keeps the results chosen by `select_results`.
+
+    Notes:
+    - Every decision is logged, see PLANNER_LOG_FILE.
+    """
+    plan = plan_query(question)
+    plan["question"] = question
+    query_embedding = embed_question(question, plan)
+    keywords = plan["keywords"] if plan["use_bm25"] else None
+    knn_results, bm25_results = search_collections(
+        query_embedding, keywords, collections, RESULTS_LIMIT, filters
+    )
+
+    # KNN scores are absolute similarities, so the best one tells how relevant the corpus is
+    if knn_results:
+        plan["confidence"] = max(row[5] for row in knn_results)
+        if plan["confidence"] < PLANNER_MIN_SCORE:
+            plan.update(outcome="not found", results_used=0)
+            log_plan(plan)
+            return []
+
+    knn_relevance, knn_flat = leg_relevance(knn_results)
+    bm25_relevance, bm25_flat = leg_relevance(bm25_results)
+    widen_knn = knn_flat and len(knn_results) >= RESULTS_LIMIT
+    widen_bm25 = bm25_flat and len(bm25_results) >= RESULTS_LIMIT
+    plan["widened"] = []
+    if PLANNER_MAX_RESULTS > RESULTS_LIMIT and (widen_knn or widen_bm25):
+        more_knn, more_bm25 = search_collections(
+            query_embedding if widen_knn else None,
+            keywords if widen_bm25 else None,
+            collections,
+            PLANNER_MAX_RESULTS,
+            filters,
+        )
+        if widen_knn and more_knn:
+            knn_results = more_knn
+            knn_relevance, _ = leg_relevance(knn_results)
+            plan["widened"].append("knn")
+        if widen_bm25 and more_bm25:
+            bm25_results = more_bm25
+            bm25_relevance, _ = leg_relevance(bm25_results)
+            plan["widened"].append("bm25")
+
+    relevance = dict(knn_relevance)
+    for key, value in bm25_relevance.items():
+        relevance[key] = max(value, relevance.get(key, 0))
+    leg_rank = {}
+    for leg in (knn_results, bm25_results):
+        for position, row in enumerate(sorted(leg, key=lambda row: row[5], reverse=True)):
+            leg_rank[(row[-1], row[0])] = min(position, leg_rank.get((row[-1], row[0]), position))
+
+    ranked = rank_hybrid_results(knn_results, bm25_results, alpha)
+    results = select_results(ranked, relevance, leg_rank)
+    plan.update(
+        outcome="answer" if results else "not found",
+        candidates=len(ranked),
+        results_used=len(results),
+    )
+    log_plan(plan)
+    return results
+
+def merge_hybrid_results(knn_results, bm25_results, alpha, results_limit):
+    """
+    Combines KNN and BM25 rows into a single list ranked by hybrid score.
+
+    Parameters:
+    - knn_results (list): KNN rows, with the score in column 5 and the collection last.
+    - bm25_results (list): BM25 rows, with the score in column 5 and the collection last.
+    - alpha (float): Weight for KNN scores in the hybrid scoring formula.
+    - results_limit (int): The maximum number of results to return.
+    """
+    results = rank_hybrid_results(knn_results, bm25_results, alpha)
+    return [result["data"] for result in results[:results_limit]]
+
+def rank_hybrid_results(knn_results, bm25_results, alpha):
+    """
+    Scores KNN and BM25 rows with the hybrid formula.
+
+    Returns:
+    - list: Dictionaries with "score" and "data" (the row), best first.
+
+    Notes:
+    - Scores are normalized against the best score of each search type across
+      all collections, so a weak collection does not get inflated scores.
+    """
+    knn_max = max(row[5] for row in knn_results) if knn_results else 1
+    bm25_max = max(row[5] for row in bm25_results) if bm25_results else 1
 
     def normalize(score, max_score):
         return score / max_score if max_score > 0 else 0
 
     merged = {}
     for row in knn_results:
-        merged[row[0]] = {"score": normalize(row[-1], knn_max) * alpha, "data": row}
+        key = (row[-1], row[0])
+        merged[key] = {"score": normalize(row[5], knn_max) * alpha, "data": row}
     for row in bm25_results:
-        if row[0] in merged:
-            merged[row[0]]["score"] += normalize(row[-1], bm25_max) * (1 - alpha)
+        key = (row[-1], row[0])
+        if key in merged:
+            merged[key]["score"] += normalize(row[5], bm25_max) * (1 - alpha)
         else:
-            merged[row[0]] = {
-                "score": normalize(row[-1], bm25_max) * (1 - alpha),
+            merged[key] = {
+                "score": normalize(row[5], bm25_max) * (1 - alpha),
                 "data": row,
             }
 
-    results = sorted(merged.values(), key=lambda x: x["score"], reverse=True)
-    return [result["data"] for result in results[:results_limit]]
+    return sorted(merged.values(), key=lambda x: x["score"], reverse=True)
 
-def generate_answer(question, context):
+def generate_answer(question, context, history=""):
     """
     Generates a concise and clear answer to the user's question based on the provided context.
 
     Parameters:
     - question (str): The user's input question.
     - context (str): The retrieved context containing relevant information.
+    - history (str): Compact conversation history, see `conversation_history`.
 
     Returns:
     - str: A text response generated by OpenAI's GPT-3.5-turbo.
@@ -195,6 +755,7 @@ def generate_answer(question, context):
     - The function uses a structured prompt to guide the language model's response. Changing the prompt will have an effect on the answers provided by the chatbot.
     - Includes sources in the prompt to provide traceability in the answer.
     """
+    history_section = f"\n    Conversation so far:\n    {history}\n" if history else ""
     prompt = f"""
     You are a skilled technical assistant. Use the following document context 
     to answer the question concisely and clearly. Focus on the most relevant 
@@ -203,7 +764,7 @@ def generate_answer(question, context):
 
     Context:
     {context}
-
+    {history_section}
     Question:
     {question}
     """
@@ -220,10 +781,182 @@ def generate_answer(question, context):
         return "I'm sorry, I couldn't generate an answer."
 
 
-def chatbot_query(question):
+def new_conversation():
+    """
+    Creates the memory for one conversation, to pass to `chatbot_query`.
+
+    Returns:
+    - dict: A rolling "summary" of older turns, the most recent "turns" as
+      (question, answer) pairs, and state for background summarization.
+    """
+    return {
+        "summary": "",
+        "turns": [],
+        "pending": [],
+        "summarizing": False,
+        "lock": threading.Lock(),
+    }
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+def conversation_history(conversation):
+    """
+    Builds the conversation history for prompts, kept under CONVERSATION_TOKEN_BUDGET.
+
+    Returns:
+    - str: The summary of older turns followed by the most recent turns.
+
+    Notes:
+    - Drops the oldest recent turns first, then truncates the summary, so the
+      prompt size stays flat however long the conversation gets.
+    - The newest turn is always kept. If it does not fit on its own, the
+      summary is left out and its answer is truncated instead.
+    """
+    with conversation["lock"]:
+        summary = conversation["summary"]
+        turns = list(conversation["turns"])
+
+    budget_chars = (CONVERSATION_TOKEN_BUDGET - 1) * 4
+    lines = [f"User: {question}\nAssistant: {answer}" for question, answer in turns]
+    while len(lines) > 1 and estimate_tokens(summary + "".join(lines)) > CONVERSATION_TOKEN_BUDGET:
+        lines.pop(0)
+    if lines and estimate_tokens(lines[-1]) > CONVERSATION_TOKEN_BUDGET:
+        question, answer = turns[-1]
+        prefix = f"User: {question}\nAssistant: "
+        lines[-1] = prefix + answer[: max(0, budget_chars - len(prefix))]
+        summary = ""
+    elif estimate_tokens(summary + "".join(lines)) > CONVERSATION_TOKEN_BUDGET:
+        summary = summary[: max(0, budget_chars - len("".join(lines)))]
+
+    parts = [f"Summary of earlier conversation: {summary}"] if summary else []
+    return "\n".join(parts + lines)
+
+def needs_rewrite(question):
+    """
+    Checks whether a question looks like a follow-up that depends on earlier turns,
+    i.e. it refers back with a third person or demonstrative pronoun such as
+    "it", "its", "they" or "this".
+
+    Notes:
+    - Wh-words ("what", "which", "who") and relative or subordinating "that"
+      are ignored, so ordinary new questions are not rewritten.
+    """
+    for token in nlp(question):
+        if token.tag_ in {"WP", "WP$", "WDT", "IN"}:
+            continue
+        pron_type = token.morph.get("PronType")
+        if "Dem" in pron_type or ("Prs" in pron_type and "3" in token.morph.get("Person")):
+            return True
+        if token.lower_ in FOLLOWUP_REFERENCES:
+            return True
+    return False
+
+def rewrite_followup(question, history):
     """
+    Rewrites a follow-up question into a standalone question for retrieval.
+
     Parameters:
     - question (str): The user's input question.
+    - history (str): Compact conversation history, see `conversation_history`.
+
+    Returns:
+    - str: The standalone question, or the original question if rewriting fails.
+    """
+    prompt = f"""
+    Rewrite the final question so that it can be understood without the
+    conversation, replacing pronouns and references with what they refer to.
+    Reply with the rewritten question only.
+
+    Conversation:
+    {history}
+
+    Final question:
+    {question}
+    """
+    try:
+        response = client.chat.completions.create(
+            model=GPT_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=100,
+            temperature=0,
+        )
+        return response.choices[0].message.content.strip() or question
+    except Exception as e:
+        print(f"Error rewriting question: {e}") if DEBUG else None
+        return question
+
+def remember_turn(conversation, question, answer):
+    """
+    Adds a turn to the conversation memory. Turns beyond CONVERSATION_RECENT_TURNS
+    are folded into the summary on a background thread, off the critical path.
+    """
+    with conversation["lock"]:
+        conversation["turns"].append((question, answer))
+        while len(conversation["turns"]) > CONVERSATION_RECENT_TURNS:
+            conversation["pending"].append(conversation["turns"].pop(0))
+        if conversation["pending"] and not conversation["summarizing"]:
+            conversation["summarizing"] = True
+            summary_executor.submit(summarize_conversation, conversation)
+
+def summarize_conversation(conversation):
+    """
+    Folds turns that dropped out of the recent window into the rolling summary.
+
+    Notes:
+    - Keeps going until no turns are pending, so turns added while a summary is
+      being generated are not lost.
+    - If the summary cannot be generated, the turns are put back and retried
+      after the next turn.
+    """
+    while True:
+        with conversation["lock"]:
+            pending = conversation["pending"]
+            if not pending:
+                conversation["summarizing"] = False
+                return
+            conversation["pending"] = []
+            summary = conversation["summary"]
+
+        turns = "\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in pending)
+        prompt = f"""
+        Update the summary of a conversation with the new turns below. Keep the
+        topics, products and facts needed to understand follow-up questions,
+        in a few sentences.
+
+        Current summary:
+        {summary or "None."}
+
+        New turns:
+        {turns}
+        """
+        try:
+            response = client.chat.completions.create(
+                model=GPT_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=CONVERSATION_SUMMARY_MAX_TOKENS,
+                temperature=0,
+            )
+            summary = response.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"Error summarizing conversation: {e}") if DEBUG else None
+            with conversation["lock"]:
+                conversation["pending"] = pending + conversation["pending"]
+                conversation["summarizing"] = False
+            return
+
+        with conversation["lock"]:
+            conversation["summary"] = summary
+
+def chatbot_query(question, filters=None, conversation=None):
+    """
+    Parameters:
+    - question (str): The user's input question.
+    - filters (dict): Optional metadata filters, see `build_filter_clause`.
+    - conversation (dict): Optional memory from `new_conversation`. Follow-up
+      questions are rewritten into standalone questions for retrieval, and the
+      answer is added to the memory.
 
     Returns:
     - dict: A dictionary containing different components of the response.  
@@ -236,9 +969,17 @@ def chatbot_query(question):
         return {
             "response": "Please ask a question."
         }
-    
-    results = perform_hybrid_search(question)
+
+    history = conversation_history(conversation) if conversation else ""
+    search_question = question
+    if history and needs_rewrite(question):
+        search_question = rewrite_followup(question, history)
+        print(f"\n### Standalone Question: {search_question} ###\n") if DEBUG else None
+
+    results = planned_search(search_question, filters=filters)
     if not results:
+        if conversation:
+            remember_turn(conversation, question, "No relevant documents found.")
         return {
             "response": "No relevant documents found.",
             "results": []
@@ -252,7 +993,7 @@ def chatbot_query(question):
     for result in results:
         print(f"DEBUG: Single result: {result}") if DEBUG else None
         # Dynamically unpack, focusing only on relevant fields
-        _, doc_name, page_num, content_type, content, score, *_ = result
+        _, doc_name, page_num, content_type, content, score, duplicate_locations, *_, collection = result
 
         # Convert score to float safely
         try:
@@ -261,7 +1002,14 @@ def chatbot_query(question):
             score = 0.0  # Default if score conversion fails
 
         # Prepare the context snippet
-        context_snippet = f"Page {page_num} (Document: {doc_name}, Type: {content_type}, Score: {score:.4f})"
+        context_snippet = f"Page {page_num} (Document: {doc_name}, Collection: {collection}, Type: {content_type}, Score: {score:.4f})"
+
+        # Chunks deduplicated at ingest also appear at these locations
+        duplicates = []
+        for location in duplicate_locations or []:
+            duplicates.append({"doc": location["document_name"], "page": location["page_number"]})
+        if duplicates:
+            context_snippet += " Also in: " + ", ".join(f"{d['doc']} page {d['page']}" for d in duplicates)
 
         if content not in unique_context:  # Avoid duplicates
             unique_context.add(content)
@@ -270,7 +1018,9 @@ def chatbot_query(question):
                 "doc": doc_name,
                 "page": page_num,
                 "type": content_type,
-                "score": score
+                "score": score,
+                "collection": collection,
+                "duplicates": duplicates
             })
 
     # Combine context for LLM
@@ -279,7 +1029,9 @@ def chatbot_query(question):
         print(f"\n### Retrieved Context with Scores ###\n{context}\n")
 
     # Generate the answer using the LLM
-    answer = generate_answer(question, context)
+    answer = generate_answer(question, context, history)
+    if conversation:
+        remember_turn(conversation, question, answer)
 
     return {
         "response": f"{GREEN}{answer}{RESET}",
@@ -288,8 +1040,10 @@ def chatbot_query(question):
     }
 
 
-def chatbot_interface():
+def chatbot_interface(filters=None):
     """
+    Parameters:
+    - filters (dict): Optional metadata filters applied to every question.
 
     Process:
     1. Prompts the user to input a question.
@@ -301,13 +1055,38 @@ def chatbot_interface():
     - Designed for iterative question-answering with minimal latency.
     """
     print("\nWelcome to the PDF Data Chatbot!")
+    conversation = new_conversation()
     while True:
         user_query = input("Ask a question ('exit' quits): ").strip()
         if user_query.lower() == "exit":
             print("Goodbye!")
             break
-        response = chatbot_query(user_query)
+        response = chatbot_query(user_query, filters, conversation)
         print(f"\nAnswer:\n{response['response']}\n\nSources:\n{response['sources'] if 'sources' in response else "None."}\n")
 
+def parse_page_range(value):
+    """
+    Parses a page range such as "3-10", "5-" or "7" into (page_from, page_to).
+    """
+    page_from, separator, page_to = value.partition("-")
+    if not separator:
+        page_to = page_from
+    try:
+        return (int(page_from) if page_from else None, int(page_to) if page_to else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid page range: {value}")
+
 if __name__ == "__main__":
-    chatbot_interface()        
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="PDF Data Chatbot")
+    parser.add_argument("--document", action="append", help="Only search this document (repeatable).")
+    parser.add_argument("--pages", type=parse_page_range, help='Only search these pages, e.g. "3-10".')
+    parser.add_argument("--content-type", action="append", choices=["text", "image"], help="Only search this content type.")
+    cli_args = parser.parse_args()
+
+    page_from, page_to = cli_args.pages or (None, None)
+    chatbot_interface({
+        "document_name": cli_args.document,
+        "page_from": page_from,
+        "page_to": page_to,
+        "content_type": cli_args.content_type,
+    })
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import random
+import re
+
+# Mersenne prime used for the MinHash permutations
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text, size):
+    """
+    Splits text into overlapping word shingles.
+
+    Parameters:
+    - text (str): The text to shingle.
+    - size (int): Number of words per shingle.
+
+    Returns:
+    - set: The distinct shingles, hashed to 32 bit integers.
+
+    Notes:
+    - Text is lowercased and stripped of punctuation first, so formatting
+      differences do not hide duplicates.
+    - Uses a stable hash so signatures can be compared across runs.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        words = words + [""] * (size - len(words))
+    return {
+        int.from_bytes(
+            hashlib.blake2b(" ".join(words[i : i + size]).encode("utf-8"), digest_size=4).digest(),
+            "big",
+        )
+        for i in range(len(words) - size + 1)
+    }
+
+
+def choose_bands(num_perm, threshold):
+    """
+    Picks the number of LSH bands so that chunks at the similarity threshold
+    have roughly even odds of sharing a bucket.
+
+    Returns:
+    - tuple: (bands, rows) with bands * rows == num_perm.
+    """
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold))
+
+
+class DedupIndex:
+    """
+    A persistent MinHash / LSH index of the text chunks already stored in CrateDB.
+
+    Chunks whose estimated Jaccard similarity with an indexed chunk reaches the
+    threshold are reported as duplicates of it. Lookups only compare against
+    chunks that share an LSH bucket, so they stay fast as the corpus grows.
+    """
+
+    def __init__(self, path, threshold=0.75, num_perm=128, shingle_size=3):
+        self.path = path
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+
+        # Fixed seed so permutations, and therefore signatures, are stable across runs
+        rng = random.Random(1)
+        self.permutations = [
+            (rng.randint(1, MERSENNE_PRIME - 1), rng.randint(0, MERSENNE_PRIME - 1))
+            for _ in range(num_perm)
+        ]
+
+        self.signatures = {}
+        self.buckets = {}
+        # Duplicate locations found this run, keyed by canonical content id
+        self.references = {}
+
+    @classmethod
+    def load(cls, path, threshold=0.75, num_perm=128, shingle_size=3):
+        """
+        Loads the index from disk, or returns an empty one if there is no
+        compatible saved index.
+        """
+        index = cls(path, threshold, num_perm, shingle_size)
+        if not os.path.exists(path):
+            return index
+
+        with open(path) as f:
+            saved = json.load(f)
+        if (saved.get("num_perm"), saved.get("shingle_size")) != (num_perm, shingle_size):
+            print(f"Dedup index {path} was built with different settings, starting a new one.")
+            return index
+
+        for content_id, signature in saved["signatures"].items():
+            index.insert(content_id, signature)
+        return index
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(
+                {
+                    "num_perm": self.num_perm,
+                    "shingle_size": self.shingle_size,
+                    "signatures": self.signatures,
+                },
+                f,
+            )
+
+    def signature(self, text):
+        hashes = shingles(text, self.shingle_size)
+        return [
+            min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes)
+            for a, b in self.permutations
+        ]
+
+    def band_keys(self, signature):
+        return [
+            f"{band}:" + ",".join(map(str, signature[band * self.rows : (band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def insert(self, content_id, signature):
+        self.signatures[content_id] = signature
+        for key in self.band_keys(signature):
+            self.buckets.setdefault(key, []).append(content_id)
+
+    def find_duplicate(self, signature):
+        """
+        Returns the id of the most similar indexed chunk at or above the
+        threshold, or None.
+        """
+        candidates = set()
+        for key in self.band_keys(signature):
+            candidates.update(self.buckets.get(key, []))
+
+        best_id, best_similarity = None, self.threshold
+        for candidate in candidates:
+            other = self.signatures[candidate]
+            similarity = sum(x == y for x, y in zip(signature, other)) / self.num_perm
+            if similarity >= best_similarity:
+                best_id, best_similarity = candidate, similarity
+        return best_id
+
+    def add_reference(self, canonical_id, document_name, page_number):
+        location = {"document_name": document_name, "page_number": page_number}
+        locations = self.references.setdefault(canonical_id, [])
+        if location not in locations:
+            locations.append(location)
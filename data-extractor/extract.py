@@ -6,6 +6,7 @@ from dotenv import load_dotenv
 from base64 import b64encode
 from requests.auth import HTTPBasicAuth
 from openai import OpenAI
+from dedup import DedupIndex
 
 
 # Load environment variables
@@ -22,6 +23,24 @@ GPT_MODEL = os.getenv("GPT_MODEL")
 TEXT_EMBEDDING_MODEL = os.getenv("TEXT_EMBEDDING_MODEL")
 MAX_IMAGE_DESCRIPTION_TOKENS = int(os.getenv("MAX_IMAGE_DESCRIPTION_TOKENS"))
 IMAGE_DESCRIPTION_TEMPERATURE = float(os.getenv("IMAGE_DESCRIPTION_TEMPERATURE"))
+TABLE_SHARDS = os.getenv("TABLE_SHARDS")
+TABLE_REPLICAS = os.getenv("TABLE_REPLICAS")
+TABLE_PARTITION_BY = os.getenv("TABLE_PARTITION_BY", "none")
+TABLE_REFRESH_INTERVAL = os.getenv("TABLE_REFRESH_INTERVAL")
+INGEST_MODE = os.getenv("INGEST_MODE", "incremental")
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "True").lower() == "true"
+DEDUP_INDEX_PATH = os.getenv("DEDUP_INDEX_PATH", "dedup_index.json")
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.75"))
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "128"))
+DEDUP_SHINGLE_SIZE = int(os.getenv("DEDUP_SHINGLE_SIZE", "3"))
+
+# Where skipped near-duplicate chunks appeared, recorded on the stored chunk
+DUPLICATE_LOCATIONS_TYPE = "ARRAY(OBJECT(STRICT) AS (document_name TEXT, page_number INT))"
+
+# Generated partition columns for each TABLE_PARTITION_BY option
+PARTITION_COLUMNS = {
+    "document_hash": ("document_bucket", "TEXT GENERATED ALWAYS AS substr(md5(document_name), 1, 1)"),
+}
 
 # Instantiate OpenAI client
 client = OpenAI(api_key=OPENAI_API_KEY)
@@ -38,23 +57,128 @@ def execute_cratedb_query(query, args=None):
         return None
     return response.json()
 
-def create_table():
+def create_table(table_name=COLLECTION_NAME):
+    """
+    Creates the table used to store extracted content, if it does not exist.
+
+    Parameters:
+    - table_name (str): Name of the table to create.
+
+    Notes:
+    - Shards, replicas and partitioning are set by TABLE_SHARDS, TABLE_REPLICAS
+      and TABLE_PARTITION_BY ("none" or "document_hash").
+    - Partitioned tables include the partition column in the primary key, as
+      CrateDB requires. The column is derived from the document name, so a
+      re-loaded document keeps the same keys and is not stored twice.
+    """
+    columns = [
+        "id TEXT",
+        "document_name TEXT",
+        "page_number INT",
+        "content_type TEXT",
+        f"content TEXT INDEX USING FULLTEXT WITH (analyzer = '{CRATEDB_FULL_TEXT_ANALYZER}')",
+        "content_embedding FLOAT_VECTOR(1536)",
+        f"duplicate_locations {DUPLICATE_LOCATIONS_TYPE}",
+    ]
+    primary_key = ["id"]
+    clauses = []
+
+    if TABLE_PARTITION_BY in PARTITION_COLUMNS:
+        partition_column, definition = PARTITION_COLUMNS[TABLE_PARTITION_BY]
+        columns.append(f"{partition_column} {definition}")
+        primary_key.append(partition_column)
+        clauses.append(f"PARTITIONED BY ({partition_column})")
+    elif TABLE_PARTITION_BY != "none":
+        print(f"Unknown TABLE_PARTITION_BY value {TABLE_PARTITION_BY}, not partitioning.")
+
+    if TABLE_SHARDS:
+        clauses.append(f"CLUSTERED INTO {int(TABLE_SHARDS)} SHARDS")
+    if TABLE_REPLICAS:
+        clauses.append(f"WITH (number_of_replicas = '{TABLE_REPLICAS}')")
+
+    column_definitions = ",\n        ".join(columns + [f"PRIMARY KEY ({', '.join(primary_key)})"])
     query = f"""
-    CREATE TABLE IF NOT EXISTS {COLLECTION_NAME} (
-        id TEXT PRIMARY KEY,
-        document_name TEXT,
-        page_number INT,
-        content_type TEXT,
-        content TEXT INDEX USING FULLTEXT WITH (analyzer = '{CRATEDB_FULL_TEXT_ANALYZER}'),
-        content_embedding FLOAT_VECTOR(1536)
-    )
+    CREATE TABLE IF NOT EXISTS {table_name} (
+        {column_definitions}
+    ) {" ".join(clauses)}
     """
     execute_cratedb_query(query)
-    execute_cratedb_query(f"REFRESH TABLE {COLLECTION_NAME}")
-    print(f"Table {COLLECTION_NAME} is ready.")
+    # Tables created before duplicate detection existed lack this column
+    execute_cratedb_query(
+        f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS duplicate_locations {DUPLICATE_LOCATIONS_TYPE}"
+    )
+    print(f"Table {table_name} is ready.")
+
+def begin_bulk_load(table_name=COLLECTION_NAME):
+    """
+    Disables periodic refreshes so inserts are not slowed down by them.
+    """
+    execute_cratedb_query(f'ALTER TABLE {table_name} SET ("refresh_interval" = 0)')
+
+def end_bulk_load(table_name=COLLECTION_NAME):
+    """
+    Restores the refresh interval and makes all loaded rows searchable with a single refresh.
+
+    Notes:
+    - Uses TABLE_REFRESH_INTERVAL (milliseconds) if set, otherwise the CrateDB default.
+    """
+    if TABLE_REFRESH_INTERVAL:
+        execute_cratedb_query(
+            f'ALTER TABLE {table_name} SET ("refresh_interval" = {int(TABLE_REFRESH_INTERVAL)})'
+        )
+    else:
+        execute_cratedb_query(f'ALTER TABLE {table_name} RESET ("refresh_interval")')
+    execute_cratedb_query(f"REFRESH TABLE {table_name}")
+
+def store_duplicate_references(dedup_index, table_name=COLLECTION_NAME):
+    """
+    Records the locations of skipped near-duplicate chunks on their canonical rows.
+
+    Parameters:
+    - dedup_index (DedupIndex): The index holding the references found this run.
+    - table_name (str): The table containing the canonical rows.
+
+    Notes:
+    - Runs after the bulk load has been refreshed, so the canonical rows are visible.
+    - Locations already recorded by an earlier run are not added again.
+    """
+    if not dedup_index.references:
+        return
+    for canonical_id, locations in dedup_index.references.items():
+        execute_cratedb_query(
+            f"""
+            UPDATE {table_name}
+            SET duplicate_locations = array_unique(coalesce(duplicate_locations, []), ?)
+            WHERE id = ?
+            """,
+            [locations, canonical_id],
+        )
+    execute_cratedb_query(f"REFRESH TABLE {table_name}")
+    print(f"Recorded duplicate locations for {len(dedup_index.references)} chunks.")
+    dedup_index.references = {}
+
+def swap_tables(shadow_table, live_table=COLLECTION_NAME):
+    """
+    Atomically replaces the live table with a fully loaded shadow table.
+
+    Parameters:
+    - shadow_table (str): The table that was just loaded.
+    - live_table (str): The table that the chatbot queries.
+
+    Returns:
+    - bool: True if the swap succeeded, False if the live table is unchanged.
+    """
+    response = execute_cratedb_query(
+        f"ALTER CLUSTER SWAP TABLE {shadow_table} TO {live_table} WITH (drop_source = true)"
+    )
+    if response is None:
+        print(f"Could not swap {shadow_table} into {live_table}, {live_table} is unchanged.")
+        return False
+    print(f"Swapped {shadow_table} into {live_table}.")
+    return True
 
 def store_in_cratedb(
-    content_id, document_name, page_number, content_type, content, embedding
+    content_id, document_name, page_number, content_type, content, embedding, table_name=COLLECTION_NAME
 ):
     """
     Stores extracted text or image data in CrateDB.
@@ -66,20 +190,28 @@ def store_in_cratedb(
     - content_type (str): Type of content ("text" or "image").
     - content (str): The actual text or image description.
     - embedding (list): The vector embedding of the content.
+    - table_name (str): The table to insert into.
+
+    Returns:
+    - bool: True if the row was inserted.
 
     Notes:
     - Inserts the data into the specified CrateDB table.
     - Content and embeddings are indexed for efficient retrieval.
     """
     query = f"""
-    INSERT INTO {COLLECTION_NAME} (id, document_name, page_number, content_type, content, content_embedding)
+    INSERT INTO {table_name} (id, document_name, page_number, content_type, content, content_embedding)
     VALUES (?, ?, ?, ?, ?, ?)
     """
-    execute_cratedb_query(
+    response = execute_cratedb_query(
         query,
         [content_id, document_name, page_number, content_type, content, embedding],
     )
+    if response is None:
+        print(f"Failed to store content: {content_id}")
+        return False
     print(f"Stored content: {content_id}")
+    return True
 
 def extract_text_with_cleaning(doc):
     """
@@ -225,7 +357,9 @@ def get_text_embedding_openai(text):
         print(f"Error generating embedding for text: {text[:50]}... Error: {e}")
         return None
 
-def generate_text_embedding(text, document_name, page_num, idx):
+def generate_text_embedding(
+    text, document_name, page_num, idx, table_name=COLLECTION_NAME, dedup_index=None
+):
     """
     Generates an embedding for a text chunk and stores it in CrateDB.
 
@@ -234,11 +368,30 @@ def generate_text_embedding(text, document_name, page_num, idx):
     - document_name (str): Name of the source document.
     - page_num (int): Page number where the text is located.
     - idx (int): Index of the chunk in the page.
+    - table_name (str): The table to store the embedding in.
+    - dedup_index (DedupIndex): If given, near-duplicates of already stored chunks
+      are skipped and recorded as references to the stored chunk instead.
     """
+    content_id = f"text_{document_name}_{page_num}_{idx}"
+    if dedup_index is not None:
+        signature = dedup_index.signature(text)
+        canonical_id = dedup_index.find_duplicate(signature)
+        if canonical_id == content_id:
+            print(f"Already stored: {content_id}")
+            return
+        if canonical_id:
+            dedup_index.add_reference(canonical_id, document_name, page_num)
+            print(f"Skipped duplicate text: {content_id} (duplicate of {canonical_id})")
+            return
+
     embedding = get_text_embedding_openai(text)
-    if embedding:
-        content_id = f"text_{document_name}_{page_num}_{idx}"
-        store_in_cratedb(content_id, document_name, page_num, "text", text, embedding)
+    if embedding and store_in_cratedb(
+        content_id, document_name, page_num, "text", text, embedding, table_name
+    ):
+        # Only stored chunks may become canonical, so later duplicates are not
+        # recorded against a row that does not exist
+        if dedup_index is not None:
+            dedup_index.insert(content_id, signature)
         print(f"Stored text embedding: {content_id}")
 
 def generate_image_description(image_bytes):
@@ -296,7 +449,9 @@ def generate_image_description(image_bytes):
         print(f"Error generating image description: {e}")
         return "Image description unavailable."
 
-def generate_image_embedding(image_bytes, surrounding_text, document_name, page_num, img_index):
+def generate_image_embedding(
+    image_bytes, surrounding_text, document_name, page_num, img_index, table_name=COLLECTION_NAME
+):
     """
     Generates a description for an image, creates an embedding, and stores it in CrateDB.
 
@@ -306,6 +461,7 @@ def generate_image_embedding(image_bytes, surrounding_text, document_name, page_
     - document_name (str): Name of the source document.
     - page_num (int): Page number where the image is located.
     - img_index (int): Index of the image on the page.
+    - table_name (str): The table to store the embedding in.
     """
     # Generate image description
     image_description = generate_image_description(image_bytes)
@@ -315,21 +471,22 @@ def generate_image_embedding(image_bytes, surrounding_text, document_name, page_
 
     # Generate embedding
     embedding = get_text_embedding_openai(combined_description)
-    if embedding:
-        content_id = f"image_{document_name}_{page_num}_{img_index}"
-        store_in_cratedb(
-            content_id, document_name, page_num, "image", combined_description, embedding
-        )
+    content_id = f"image_{document_name}_{page_num}_{img_index}"
+    if embedding and store_in_cratedb(
+        content_id, document_name, page_num, "image", combined_description, embedding, table_name
+    ):
         print(f"Stored image embedding: {content_id}")
 
 
-def process_pdf(pdf_path):
+def process_pdf(pdf_path, table_name=COLLECTION_NAME, dedup_index=None):
     """
     Processes a PDF file by extracting text and images, generating embeddings,
     and storing the data in CrateDB.
 
     Parameters:
     - pdf_path (str): The file path of the PDF to process.
+    - table_name (str): The table to store the extracted data in.
+    - dedup_index (DedupIndex): Optional index used to skip near-duplicate text chunks.
     """
     print(f"Processing {pdf_path}")
     doc = fitz.open(pdf_path)
@@ -342,7 +499,7 @@ def process_pdf(pdf_path):
         chunk_text = chunk_data["text"]
 
         # Generate text embedding
-        generate_text_embedding(chunk_text, document_name, page_num, idx)
+        generate_text_embedding(chunk_text, document_name, page_num, idx, table_name, dedup_index)
 
     # Process images with clean, minimal surrounding context
     for page_num, page in enumerate(doc):
@@ -361,13 +518,17 @@ def process_pdf(pdf_path):
 
             # Generate image embedding
             generate_image_embedding(
-                image_bytes, surrounding_text, document_name, page_num + 1, img_index
+                image_bytes, surrounding_text, document_name, page_num + 1, img_index, table_name
             )
 
-def process_local_pdfs():
+def process_local_pdfs(table_name=COLLECTION_NAME, dedup_index=None):
     """
     Processes all PDFs in the specified directory.
 
+    Parameters:
+    - table_name (str): The table to store the extracted data in.
+    - dedup_index (DedupIndex): Optional index used to skip near-duplicate text chunks.
+
     Process:
     1. Iterates through PDF files in the directory.
     2. Calls `process_pdf` for each file to extract and store data.
@@ -381,12 +542,41 @@ def process_local_pdfs():
         return
     for pdf_file in pdf_files:
         pdf_path = os.path.join(PDF_DIR, pdf_file)
-        process_pdf(pdf_path)
+        process_pdf(pdf_path, table_name, dedup_index)
 
 if __name__ == "__main__":
-    # Step 1: Create or refresh the database table
-    create_table()
-
-    # Step 2: Process all PDFs in the specified directory
-    process_local_pdfs()  
-
+    bluegreen = INGEST_MODE == "bluegreen"
+
+    # Step 1: Create the database table. In blue/green mode, load a fresh
+    # shadow table so the live table keeps serving queries.
+    if bluegreen:
+        target_table = f"{COLLECTION_NAME}_shadow"
+        execute_cratedb_query(f"DROP TABLE IF EXISTS {target_table}")
+        create_table(COLLECTION_NAME)
+    else:
+        target_table = COLLECTION_NAME
+    create_table(target_table)
+
+    # The dedup index describes the live table, so a blue/green rebuild starts
+    # from an empty one and only replaces the saved index after the swap.
+    dedup_index = None
+    if DEDUP_ENABLED:
+        dedup_settings = (DEDUP_INDEX_PATH, DEDUP_THRESHOLD, DEDUP_NUM_PERM, DEDUP_SHINGLE_SIZE)
+        dedup_index = DedupIndex(*dedup_settings) if bluegreen else DedupIndex.load(*dedup_settings)
+
+    # Step 2: Process all PDFs in the specified directory, refreshing once at the end
+    begin_bulk_load(target_table)
+    try:
+        process_local_pdfs(target_table, dedup_index)
+    finally:
+        end_bulk_load(target_table)
+        if dedup_index is not None:
+            store_duplicate_references(dedup_index, target_table)
+            if not bluegreen:
+                dedup_index.save()
+
+    # Step 3: Swap the fully loaded shadow table in
+    if bluegreen:
+        swapped = swap_tables(target_table, COLLECTION_NAME)
+        if swapped and dedup_index is not None:
+            dedup_index.save()